@@ -1,10 +1,17 @@
 import dash
 from dash import dcc, html, dash_table, Input, Output, State
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
 import datetime as dt
 import base64
+import functools
 import io
+import json
+import threading
+import uuid
 
 # Initialize Dash app
 app = dash.Dash(__name__)
@@ -12,30 +19,70 @@ app.title = 'Activity Tracker and Analyzer'
 
 # Expected columns for validation
 EXPECTED_COLUMNS = ['Type', 'Start', 'End', 'Duration', 'Start Condition', 'Start Location', 'End Condition', 'Notes']
+EXPECTED_COLUMNS_INDEX = pd.Index(EXPECTED_COLUMNS)
+
+# Shared layout for calendar heatmaps, built once on top of the default Plotly template
+HEATMAP_TEMPLATE = go.layout.Template(pio.templates['plotly'])
+HEATMAP_TEMPLATE.layout.update(
+    xaxis_title_text='Date',
+    yaxis_title_text='Hour of Day',
+    yaxis=dict(dtick=1),
+    xaxis=dict(tickformat="%Y-%m-%d", tickmode='array')
+)
 
 # Function to check column names in uploaded data
 def validate_csv_columns(df):
-    if list(df.columns) != EXPECTED_COLUMNS:
+    if not df.columns.equals(EXPECTED_COLUMNS_INDEX):
         raise ValueError("CSV format does not match the expected columns")
 
+# Function to parse a timestamp column, using pandas' fast ISO 8601 parser when the first value allows it
+def parse_timestamps(series):
+    try:
+        pd.to_datetime(series.dropna().head(1), format='ISO8601')
+        timestamp_format = 'ISO8601'
+    except (ValueError, TypeError):
+        timestamp_format = None
+    return pd.to_datetime(series, format=timestamp_format, errors='coerce', cache=True)
+
 # Function to convert 'Duration' into seconds
 def convert_duration_to_minutes(df):
-    # Ensure 'Duration' is a string and handle non-string entries gracefully
-    df['Duration_minutes'] = df['Duration'].apply(lambda x: int(x.split(':')[0]) * 60 + int(x.split(':')[1]) if isinstance(x, str) and ':' in x else None)
+    # Split on ':' and keep the first two parts; non-string entries or entries without a colon become NA
+    parts = df['Duration'].astype(str).str.split(':', expand=True).reindex(columns=[0, 1])
+    hours = pd.to_numeric(parts[0], errors='coerce').astype('Int32')
+    minutes = pd.to_numeric(parts[1], errors='coerce').astype('Int32')
+    df['Duration_minutes'] = hours * 60 + minutes
     return df
 
+# Function to get the 'Start' values in wall-clock time, so timezone-aware stamps keep their local day and hour
+def wall_clock_starts(df):
+    starts = df['Start']
+    if starts.dt.tz is not None:
+        starts = starts.dt.tz_localize(None)
+    return starts
+
+# Function to count events per day from a histogram of 'Start' day numbers
+def count_events_per_day(df):
+    day_codes = wall_clock_starts(df).dropna().values.astype('datetime64[D]').astype(np.int64)
+    if day_codes.size == 0:
+        return pd.Series(dtype='int64', index=pd.DatetimeIndex([]))
+    first_day = day_codes.min()
+    counts = np.bincount(day_codes - first_day)
+    # Keep only days that have events, matching what a groupby would return
+    active_days = counts.nonzero()[0]
+    return pd.Series(counts[active_days], index=pd.to_datetime(active_days + first_day, unit='D'))
+
 # Function to check if 'Feed' and 'Diaper' types have intervals within 5 minutes
 def check_close_time_intervals(df):
-    feed_data = df[df['Type'] == 'Feed']
-    diaper_data = df[df['Type'] == 'Diaper']
+    feed_data = df[df['Type'] == 'Feed'].dropna(subset=['Start']).sort_values('Start')
+    diaper_data = df[df['Type'] == 'Diaper'].dropna(subset=['End']).sort_values('End')
     
-    # Merge to get pairs of Feed and Diaper events that are within 15 minutes of each other
-    merged_data = pd.merge(feed_data, diaper_data, how='inner', suffixes=('_Feed', '_Diaper'), on='Start Location')
-    merged_data['Close_interval'] = (
-        (merged_data['Start_Feed'] - merged_data['End_Diaper']).abs().dt.total_seconds() <= 900
+    # Match each Feed to the nearest Diaper at the same location within 15 minutes of it
+    merged_data = pd.merge_asof(
+        feed_data, diaper_data, left_on='Start', right_on='End', by='Start Location',
+        suffixes=('_Feed', '_Diaper'), tolerance=pd.Timedelta(minutes=15), direction='nearest'
     )
     
-    return merged_data[merged_data['Close_interval']]
+    return merged_data.dropna(subset=['End_Diaper'])
 
 # Layout for the Dash app
 app.layout = html.Div([
@@ -48,6 +95,10 @@ app.layout = html.Div([
         multiple=False
     ),
     html.Div(id='upload-alert', style={'color': 'red'}),
+    html.Div(id='dataset-alert', style={'color': 'red'}),
+    
+    # Version of the uploaded dataset the callbacks below should read
+    dcc.Store(id='data-version'),
     
     # Dropdown for 'Type' values
     html.Label('Select Type:'),
@@ -70,8 +121,11 @@ app.layout = html.Div([
     dcc.Graph(id='calendar-heatmap')
 ])
 
-# Global variable to store uploaded data
-uploaded_data = None
+# Uploaded datasets keyed by a random version id, each holding the data, its per-'Type' slices and their event counts per day.
+# The id is never reused, so it also keys the memoized callback results built from that dataset.
+datasets = {}
+datasets_lock = threading.Lock()
+MAX_DATASETS = 4
 
 # Callback to handle file upload and validate columns
 @app.callback(
@@ -79,75 +133,130 @@ uploaded_data = None
     Output('type-selector', 'options'),
     Output('date-picker-range', 'start_date'),
     Output('date-picker-range', 'end_date'),
+    Output('data-version', 'data'),
     Input('upload-data', 'contents'),
     State('upload-data', 'filename')
 )
 def handle_file_upload(contents, filename):
-    global uploaded_data
-    
     if contents:
         try:
             # Decode the content from base64
-            content_type, content_string = contents.split(',')
+            content_type, _, content_string = contents.partition(',')
             decoded_content = base64.b64decode(content_string)
             
-            # Read the CSV into a DataFrame
-            df = pd.read_csv(io.StringIO(decoded_content.decode('utf-8')))
+            # Read the CSV into a DataFrame straight from the decoded bytes
+            df = pd.read_csv(io.BytesIO(decoded_content), encoding='utf-8')
             
             # Validate the format
             validate_csv_columns(df)
             
             # Convert 'Start' and 'End' columns to datetime
-            df['Start'] = pd.to_datetime(df['Start'], errors='coerce')
-            df['End'] = pd.to_datetime(df['End'], errors='coerce')
+            df['Start'] = parse_timestamps(df['Start'])
+            df['End'] = parse_timestamps(df['End'])
+            
+            # Store 'Type' as a categorical so equality filters and grouping work on integer codes
+            df['Type'] = df['Type'].astype('category')
             
             # Convert 'Duration' to seconds
-            uploaded_data = convert_duration_to_minutes(df)
+            df = convert_duration_to_minutes(df)
+            
+            # Split the data by 'Type' once and count events per day for each group
+            type_groups = {type_value: group for type_value, group in df.groupby('Type', sort=False, observed=True)}
+            daily_event_counts = {type_value: count_events_per_day(group) for type_value, group in type_groups.items()}
+            
+            # Keep the dataset under a new version, dropping the oldest ones beyond MAX_DATASETS
+            version = uuid.uuid4().hex
+            with datasets_lock:
+                datasets[version] = (df, type_groups, daily_event_counts)
+                while len(datasets) > MAX_DATASETS:
+                    del datasets[next(iter(datasets))]
             
-            # Populate the 'Type' dropdown options
-            type_options = [{'label': type, 'value': type} for type in uploaded_data['Type'].unique()]
+            # Populate the 'Type' dropdown options from the categories, which are already deduplicated and sorted
+            type_options = [{'label': type, 'value': type} for type in df['Type'].cat.categories]
             
             # Set default date range for date pickers
-            start_date = uploaded_data['Start'].min().date()
-            end_date = uploaded_data['Start'].max().date()
+            start_date = df['Start'].min().date()
+            end_date = df['Start'].max().date()
             
-            return f"File '{filename}' uploaded successfully!", type_options, start_date, end_date
+            return f"File '{filename}' uploaded successfully!", type_options, start_date, end_date, version
         except Exception as e:
-            return f"Error: {str(e)}", [], None, None
-    return '', [], None, None
+            return f"Error: {str(e)}", [], None, None, None
+    return '', [], None, None, None
 
 
+# Callback to tell the user when their dataset has been dropped to make room for newer uploads
+@app.callback(
+    Output('dataset-alert', 'children'),
+    [Input('data-version', 'data'),
+     Input('type-selector', 'value'),
+     Input('date-picker-range', 'start_date'),
+     Input('date-picker-range', 'end_date'),
+     Input('heatmap-type-input', 'value')]
+)
+def check_dataset_available(version, *_):
+    if version is not None and version not in datasets:
+        return 'Dataset expired, please re-upload the file.'
+    return ''
+
 # Callback to update chart and table based on 'Type' selection
 @app.callback(
     [Output('event-chart', 'figure'),
      Output('event-table', 'data')],
-    [Input('type-selector', 'value')]
+    [Input('type-selector', 'value'),
+     Input('data-version', 'data')]
 )
-def update_chart(type_value):
-    if uploaded_data is None or type_value is None:
+def update_chart(type_value, version):
+    if version is None:
         return {}, []
     
-    filtered_data = uploaded_data[uploaded_data['Type'] == type_value]
-    event_counts = filtered_data.groupby(filtered_data['Start'].dt.date).size().reset_index(name='Event Count')
-    fig = px.line(event_counts, x='Start', y='Event Count', title=f'Event Count Over Time for {type_value}')
+    return build_event_chart(type_value, version)
 
-    return fig, event_counts.to_dict('records')
+# Build the event chart and table for a 'Type', memoized per uploaded dataset
+@functools.lru_cache(maxsize=32)
+def build_event_chart(type_value, version):
+    dataset = datasets.get(version)
+    if dataset is None or type_value not in dataset[2]:
+        return {}, []
+    
+    _, _, daily_event_counts = dataset
+    event_counts = daily_event_counts[type_value].rename_axis('Start').reset_index(name='Event Count')
+    event_counts['Start'] = event_counts['Start'].dt.date
+    fig = px.line(event_counts, x='Start', y='Event Count', title=f'Event Count Over Time for {type_value}', render_mode='webgl')
+
+    # Serialize the figure once here so cached results skip Plotly's encoding on every callback
+    return json.loads(fig.to_json()), event_counts.to_dict('records')
 
 # Callback to calculate average daily values for 'Feed'
 @app.callback(
     Output('average-daily-table', 'data'),
     [Input('date-picker-range', 'start_date'),
-     Input('date-picker-range', 'end_date')]
+     Input('date-picker-range', 'end_date'),
+     Input('data-version', 'data')]
 )
-def update_average_table(start_date, end_date):
-    if uploaded_data is None:
+def update_average_table(start_date, end_date, version):
+    if version is None:
+        return []
+    
+    return build_average_table(start_date, end_date, version)
+
+# Build the average daily values for 'Feed' in a date range, memoized per uploaded dataset
+@functools.lru_cache(maxsize=32)
+def build_average_table(start_date, end_date, version):
+    dataset = datasets.get(version)
+    if dataset is None:
         return []
     
-    filtered_data = uploaded_data[(uploaded_data['Start'].dt.date >= pd.to_datetime(start_date).date()) & 
-                                  (uploaded_data['Start'].dt.date <= pd.to_datetime(end_date).date()) & 
-                                  (uploaded_data['Type'] == 'Feed')]
-    avg_duration = filtered_data['Duration_minutes'].mean()
-    avg_events = filtered_data.groupby(filtered_data['Start'].dt.date).size().mean()
+    uploaded_data, type_groups, daily_event_counts = dataset
+    
+    # Compare raw datetime64 values against the range instead of building per-row date objects
+    start_ts = pd.Timestamp(start_date)
+    end_ts = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+    feed_data = type_groups.get('Feed', uploaded_data.iloc[:0])
+    feed_starts = wall_clock_starts(feed_data).values
+    in_range = (feed_starts >= start_ts.to_datetime64()) & (feed_starts < end_ts.to_datetime64())
+    avg_duration = feed_data['Duration_minutes'][in_range].mean()
+    feed_counts = daily_event_counts.get('Feed', pd.Series(dtype='int64'))
+    avg_events = feed_counts.loc[start_ts:end_ts - pd.Timedelta(days=1)].mean()
 
     result_df = pd.DataFrame({
         'Average Duration (Minutes)': [avg_duration],
@@ -158,48 +267,61 @@ def update_average_table(start_date, end_date):
 # Callback to generate calendar heatmap based on type selection
 @app.callback(
     Output('calendar-heatmap', 'figure'),
-    [Input('heatmap-type-input', 'value')]
+    [Input('heatmap-type-input', 'value'),
+     Input('data-version', 'data')]
 )
-def update_calendar_heatmap(type_value):
-    if uploaded_data is None or type_value is None:
+def update_calendar_heatmap(type_value, version):
+    if version is None:
         return {}
 
-    # Filter data for selected type
-    filtered_data = uploaded_data[uploaded_data['Type'] == type_value]
+    return build_calendar_heatmap(type_value, version)
+
+# Build the calendar heatmap for a 'Type', memoized per uploaded dataset
+@functools.lru_cache(maxsize=32)
+def build_calendar_heatmap(type_value, version):
+    dataset = datasets.get(version)
+    if dataset is None or type_value not in dataset[1]:
+        return {}
     
-    # Extract day and hour from 'Start' timestamp
-    filtered_data['Day'] = filtered_data['Start'].dt.date
-    filtered_data['Hour'] = filtered_data['Start'].dt.hour
+    # Look up the precomputed data for selected type
+    _, type_groups, _ = dataset
+    filtered_data = type_groups[type_value]
     
-    # Generate a pivot table with counts by day and hour
-    heatmap_data = filtered_data.pivot_table(index='Hour', columns='Day', aggfunc='size', fill_value=0)
+    # Extract day and hour from 'Start' as local arrays rather than new DataFrame columns
+    starts = wall_clock_starts(filtered_data).dropna().values
+    if starts.size == 0:
+        return {}
+    days = starts.astype('datetime64[D]')
+    hours = (starts.astype('datetime64[h]') - days).astype(np.int64)
+    first_day = days.min()
+    day_offsets = (days - first_day).astype(np.int64)
+    n_days = int(day_offsets.max()) + 1
+    day_values = first_day + np.arange(n_days)
+    
+    # Count events per hour and day over a contiguous range of days
+    heatmap_counts, _, _ = np.histogram2d(hours, day_offsets, bins=[np.arange(25), np.arange(n_days + 1)])
+    heatmap_counts = heatmap_counts.astype(np.int32)
     
     # Create heatmap figure
     fig = go.Figure(
         data=go.Heatmap(
-            z=heatmap_data.values,
-            x=heatmap_data.columns,
-            y=heatmap_data.index,
+            z=heatmap_counts,
+            x=day_values,
+            y=np.arange(24),
             colorscale='Viridis',
             colorbar=dict(title="Number of Events"),
             hoverongaps=False
         )
     )
     
-    # Set titles and labels for the heatmap
+    # Apply the shared heatmap layout and set only what depends on the data
     fig.update_layout(
+        template=HEATMAP_TEMPLATE,
         title=f'Calendar Heatmap of Events by Hour and Day for {type_value}',
-        xaxis_title='Date',
-        yaxis_title='Hour of Day',
-        yaxis=dict(dtick=1),
-        xaxis=dict(
-            tickformat="%Y-%m-%d",
-            tickmode='array',
-            tickvals=heatmap_data.columns
-        )
+        xaxis_tickvals=day_values
     )
 
-    return fig
+    return json.loads(fig.to_json())
 
 if __name__ == '__main__':
     app.run_server(debug=True,port=8400)